@@ -1,4 +1,5 @@
 from monitor.monitor import NodeMonitor
+import asyncio
 import logging
 
 logging.basicConfig(
@@ -9,4 +10,4 @@ logging.basicConfig(
 
 if __name__ == "__main__":
     monitor = NodeMonitor()
-    monitor.monitor()
+    asyncio.run(monitor.monitor())
@@ -1,5 +1,7 @@
 from dotenv import load_dotenv
+import functools
 import os
+import redis
 
 load_dotenv()
 
@@ -22,6 +24,16 @@ class Config:
         LOG_LEVEL = "INFO"
 
 
+# Общий пул соединений Redis для всех компонентов
+REDIS_POOL = redis.ConnectionPool(
+    host=Config.REDIS_HOST,
+    port=Config.REDIS_PORT,
+    db=Config.REDIS_DB,
+    password=Config.REDIS_PASSWORD,
+    max_connections=32,
+)
+
+
 class Responses:
     LANG = os.getenv("LANG", "ru")
 
@@ -164,10 +176,16 @@ class Responses:
         },
     }
 
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _get_template(lang, message_key):
+        """Возвращает шаблон сообщения с кешированием поиска."""
+        return Responses.MESSAGES[lang].get(message_key)
+
     @classmethod
     def get_message(cls, message_key, **kwargs):
         """Возвращает сообщение на текущем языке с подстановкой переменных."""
-        message_template = cls.MESSAGES[cls.LANG].get(message_key)
+        message_template = cls._get_template(cls.LANG, message_key)
         if message_template:
-            return message_template.format(**kwargs)
+            return message_template.format_map(kwargs)
         return f"Message with key '{message_key}' not found."
@@ -1,50 +1,90 @@
+import asyncio
 import httpx
 import logging
 import time
 import redis
-from .config import Config
+from .config import Config, REDIS_POOL
 
 
 class MarzbanAPI:
-    def __init__(self):
+    def __init__(self, redis_client=None):
         self.base_url = Config.MARZBAN_BASE_URL
-        self.redis = redis.Redis(
-            host=Config.REDIS_HOST,
-            port=Config.REDIS_PORT,
-            db=Config.REDIS_DB,
-            password=Config.REDIS_PASSWORD,
-        )
+        self.redis = redis_client or redis.Redis(connection_pool=REDIS_POOL)
         self.token_key = "marzban_access_token"
         self.token_expiry_key = "marzban_token_expiry"
-        self.session = httpx.Client(timeout=30.0)
+        # Лимиты рассчитаны на параллельные запросы по всем узлам; повторы
+        # при ошибках соединения выполняет транспорт
+        limits = httpx.Limits(
+            max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0
+        )
+        self.async_session = httpx.AsyncClient(
+            timeout=30.0,
+            transport=httpx.AsyncHTTPTransport(retries=2, http2=True, limits=limits),
+        )
         self.auth_token = None
+        # Токен в памяти процесса, чтобы не обращаться к Redis на каждый запрос
+        self._token_cached_value = None
+        self._token_cached_until = 0.0
+        # Одновременные промахи кеша выполняют аутентификацию только один раз
+        self._token_lock = asyncio.Lock()
 
-    def __del__(self):
-        """Закрытие HTTP-сессии при завершении работы объекта."""
+    async def close(self):
+        """Закрытие HTTP-сессии."""
         try:
-            self.session.close()
+            await self.async_session.aclose()
         except Exception as e:
             logging.warning(f"Failed to close HTTP session: {e}")
 
-    def get_cached_token(self):
-        """Получение токена из кеша Redis."""
-        try:
-            token = self.redis.get(self.token_key)
-            expiry = self.redis.get(self.token_expiry_key)
-
-            if token and expiry and time.time() < float(expiry):
-                logging.info(f"Using cached access token: {token.decode('utf-8')}")
-                return token.decode('utf-8')
-            else:
-                return self.authenticate()
-        except redis.RedisError as e:
-            logging.error(f"Redis error: {e}. Falling back to re-authentication.")
-            return self.authenticate()
-
-    def authenticate(self):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _memory_token(self):
+        """Токен из памяти процесса, если он еще действителен."""
+        if self._token_cached_value and time.monotonic() < self._token_cached_until:
+            return self._token_cached_value
+        return None
+
+    async def get_cached_token(self):
+        """Получение токена из памяти процесса или из кеша Redis."""
+        token = self._memory_token()
+        if token:
+            return token
+
+        async with self._token_lock:
+            # Токен мог быть получен другой задачей, пока эта ждала блокировку
+            token = self._memory_token()
+            if token:
+                return token
+
+            try:
+                token, expiry = self.redis.mget(self.token_key, self.token_expiry_key)
+
+                if token and expiry and time.time() < float(expiry):
+                    logging.info(
+                        f"Using cached access token: {token.decode('utf-8')}"
+                    )
+                    self._cache_token(
+                        token.decode('utf-8'), float(expiry) - time.time()
+                    )
+                    return token.decode('utf-8')
+                else:
+                    return await self.authenticate()
+            except redis.RedisError as e:
+                logging.error(f"Redis error: {e}. Falling back to re-authentication.")
+                return await self.authenticate()
+
+    def _cache_token(self, token, expires_in):
+        """Сохранение токена в памяти с запасом в 60 секунд до истечения."""
+        self._token_cached_value = token
+        self._token_cached_until = time.monotonic() + expires_in - 60
+
+    async def authenticate(self):
         """Аутентификация и получение токена от API Marzban."""
         try:
-            response = self.session.post(
+            response = await self.async_session.post(
                 f"{self.base_url}/admin/token",
                 data={
                     "grant_type": "password",
@@ -58,11 +98,12 @@ class MarzbanAPI:
 
             self.auth_token = token_data.get("access_token")
             expires_in = token_data.get("expires_in", 3600)
+            self._cache_token(self.auth_token, expires_in)
 
-            self.redis.set(self.token_key, self.auth_token, ex=expires_in)
-            self.redis.set(
-                self.token_expiry_key, time.time() + expires_in, ex=expires_in
-            )
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(self.token_key, self.auth_token, ex=expires_in)
+            pipe.set(self.token_expiry_key, time.time() + expires_in, ex=expires_in)
+            pipe.execute()
 
             logging.info(
                 f"Authenticated successfully. New access token: {self.auth_token}"
@@ -72,40 +113,35 @@ class MarzbanAPI:
             logging.error(f"Authentication failed: {e}")
             raise Exception(f"Authentication failed: {e}")
 
-    def get_auth_headers(self):
+    async def get_auth_headers(self):
         """Создание заголовков для авторизации."""
-        token = self.get_cached_token()
+        token = await self.get_cached_token()
         return {"Authorization": f"Bearer {token}"}
 
-    def get_nodes(self, retries=3, delay=5):
-        """Получение списка узлов с поддержкой ретраев."""
-        for attempt in range(retries):
-            try:
-                headers = self.get_auth_headers()
-                response = self.session.get(
-                    f"{self.base_url}/nodes", headers=headers
-                )
-                response.raise_for_status()
-                nodes = response.json()
-
-                if not isinstance(nodes, list):
-                    raise ValueError(
-                        "Unexpected response format. Expected a list of nodes.")
-
-                return nodes
-            except httpx.RequestError as e:
-                logging.warning(f"Attempt {attempt + 1}/{retries} failed: {e}")
-                time.sleep(delay)
-            except Exception as e:
-                logging.error(f"Failed to retrieve nodes: {e}")
-                raise
-        raise Exception("Exceeded maximum retries for get_nodes")
-
-    def get_node(self, node_id):
-        """Получение информации об узле по ID."""
+    async def get_nodes_async(self):
+        """Асинхронное получение списка узлов."""
+        try:
+            headers = await self.get_auth_headers()
+            response = await self.async_session.get(
+                f"{self.base_url}/nodes", headers=headers
+            )
+            response.raise_for_status()
+            nodes = response.json()
+
+            if not isinstance(nodes, list):
+                raise ValueError(
+                    "Unexpected response format. Expected a list of nodes.")
+
+            return nodes
+        except httpx.HTTPError as e:
+            logging.error(f"Failed to retrieve nodes: {e}")
+            raise Exception(f"Failed to retrieve nodes: {e}")
+
+    async def get_node_async(self, node_id):
+        """Асинхронное получение информации об узле по ID."""
         try:
-            headers = self.get_auth_headers()
-            response = self.session.get(
+            headers = await self.get_auth_headers()
+            response = await self.async_session.get(
                 f"{self.base_url}/node/{node_id}", headers=headers
             )
             response.raise_for_status()
@@ -114,11 +150,11 @@ class MarzbanAPI:
             logging.error(f"Failed to retrieve node {node_id}: {e}")
             raise Exception(f"Failed to retrieve node {node_id}: {e}")
 
-    def reconnect_node(self, node_id):
-        """Переподключение узла по ID."""
+    async def reconnect_node_async(self, node_id):
+        """Асинхронное переподключение узла по ID."""
         try:
-            headers = self.get_auth_headers()
-            response = self.session.post(
+            headers = await self.get_auth_headers()
+            response = await self.async_session.post(
                 f"{self.base_url}/node/{node_id}/reconnect", headers=headers
             )
             response.raise_for_status()
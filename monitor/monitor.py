@@ -1,27 +1,41 @@
+import asyncio
+import signal
 import time
-from datetime import datetime
 from .telegram_notifier import TelegramNotifier
 from .marzban_api import MarzbanAPI
-from .config import Config, Responses
+from .config import Responses, REDIS_POOL
 import redis
 import logging
 
+# Кеш отформатированного времени с точностью до секунды
+_now_cache = [0, ""]
+
+
+def _now_str():
+    """Возвращает текущее время строкой, форматируя его не чаще раза в секунду."""
+    t = int(time.time())
+    if t != _now_cache[0]:
+        _now_cache[0] = t
+        _now_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+    return _now_cache[1]
+
 
 class NodeMonitor:
     def __init__(self):
         # Основные компоненты
-        self.api = MarzbanAPI()
+        self.redis = redis.Redis(connection_pool=REDIS_POOL)
+        self.api = MarzbanAPI(redis_client=self.redis)
         self.notifier = TelegramNotifier()
-        self.redis = redis.Redis(
-            host=Config.REDIS_HOST,
-            port=Config.REDIS_PORT,
-            db=Config.REDIS_DB,
-            password=Config.REDIS_PASSWORD,
-        )
 
-        # Префиксы для ключей Redis
-        self.node_status_key_prefix = "node_status:"
+        # Очередь уведомлений, чтобы запросы к Telegram не блокировали мониторинг
+        self.notify_queue = asyncio.Queue()
+        self.notify_flush_timeout = 5
+
+        # Ключи Redis: множество отключенных узлов и префикс времени отключения
+        self.disconnected_nodes_key = "disconnected_nodes"
         self.node_disconnect_time_prefix = "node_disconnect_time:"
+        # Префикс флагов отключения из предыдущих версий (переносятся при запуске)
+        self.legacy_node_status_prefix = "node_status:"
 
         # Параметры задержек и попыток
         self.sleep_interval = 30
@@ -29,202 +43,330 @@ class NodeMonitor:
         self.reconnect_delay = 5
         self.node_check_delay = 10
 
-    def get_node_status_key(self, node_id):
-        return f"{self.node_status_key_prefix}{node_id}"
+        # Время жизни состояния узла в Redis (сутки), продлевается каждым
+        # неудачным циклом, чтобы ключи исчезнувших узлов не копились
+        self.node_state_ttl = 24 * 60 * 60
+
+    def notify(self, message, parse_mode="HTML"):
+        """Ставит уведомление в очередь на отправку в Telegram."""
+        self.notify_queue.put_nowait((message, {"parse_mode": parse_mode}))
 
-    def get_node_disconnect_time_key(self, node_id):
-        return f"{self.node_disconnect_time_prefix}{node_id}"
+    async def notify_worker(self):
+        """Отправляет уведомления из очереди по одному, сохраняя их порядок."""
+        while True:
+            message, options = await self.notify_queue.get()
+            try:
+                await asyncio.to_thread(self.notifier.send_message, message, **options)
+            except Exception as e:
+                logging.error("Ошибка при отправке уведомления: %s", e)
+            finally:
+                self.notify_queue.task_done()
 
     def log_node_info(self, node):
-        logging.info(f"--- Узел: {node.get('name', 'Неизвестный узел')} ---")
-        logging.info(f"ID: {node.get('id', 'Неизвестно')}")
-        logging.info(f"Адрес: {node.get('address', 'IP не указан')}")
-        logging.info(f"Порт: {node.get('port', 'Неизвестно')}")
-        logging.info(f"Статус: {node.get('status', 'Неизвестно')}")
-        logging.info(f"Сообщение: {node.get('message', 'Ошибка не указана')}")
-
-    def monitor(self):
-        self.notifier.send_message(
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return
+        logging.info("--- Узел: %s ---", node.get("name", "Неизвестный узел"))
+        logging.info("ID: %s", node.get("id", "Неизвестно"))
+        logging.info("Адрес: %s", node.get("address", "IP не указан"))
+        logging.info("Порт: %s", node.get("port", "Неизвестно"))
+        logging.info("Статус: %s", node.get("status", "Неизвестно"))
+        logging.info("Сообщение: %s", node.get("message", "Ошибка не указана"))
+
+    async def handle_node(
+        self, node, node_disconnect_time_key, is_disconnected, disconnect_time,
+        write_pipe, now_str
+    ):
+        self.log_node_info(node)
+
+        node_id = node["id"]
+        node_name = node["name"]
+        node_ip = node.get("address", "IP не указан")
+        node_message = node.get("message", "Ошибка не указана")
+
+        # Статус уже содержится в ответе /nodes, отдельный запрос не нужен
+        current_status = node.get("status", "unknown")
+        logging.info("Статус узла %s: %s", node_name, current_status)
+
+        # Если узел восстановился
+        if is_disconnected and current_status == "connected":
+            if disconnect_time:
+                disconnect_time = float(disconnect_time)
+                reconnect_time = time.time()
+                downtime = reconnect_time - disconnect_time
+                downtime_minutes = round(downtime / 60, 2)
+                timestamp_reconnect = now_str
+                logging.info(
+                    "Узел %s восстановлен через %s минут.", node_name, downtime_minutes
+                )
+                self.notify(
+                    Responses.get_message(
+                        "SUCCESS_NODE_RECONNECTED",
+                        node_name=node_name,
+                        node_ip=node_ip,
+                        timestamp=timestamp_reconnect,
+                        downtime_minutes=downtime_minutes,
+                    ),
+                    parse_mode="HTML",
+                )
+            write_pipe.srem(self.disconnected_nodes_key, node_id)
+            write_pipe.delete(node_disconnect_time_key)
+
+        # Если узел отключен
+        if current_status not in ["connected", "disabled"]:
+            timestamp = now_str
+            logging.warning(
+                "Узел %s (%s) отключен. Попытка переподключения в %s...",
+                node_name,
+                node_ip,
+                timestamp,
+            )
+
+            if not is_disconnected:
+                self.notify(
+                    Responses.get_message(
+                        "ERROR_NODE_DISCONNECTED",
+                        node_name=node_name,
+                        node_ip=node_ip,
+                        error_message=node_message,
+                        timestamp=timestamp,
+                    ),
+                    parse_mode="HTML",
+                )
+                disconnect_time = time.time()
+                write_pipe.set(
+                    node_disconnect_time_key, disconnect_time, ex=self.node_state_ttl
+                )
+
+            # Попытка переподключения
+            attempts = await self.reconnect_with_verify(node_id, node_name)
+            now_str = _now_str()
+
+            if attempts:
+                timestamp_reconnect = now_str
+                downtime = time.time() - float(disconnect_time or time.time())
+                downtime_minutes = round(downtime / 60, 2)
+                logging.info(
+                    "Узел %s успешно переподключен в %s после %s попыток.",
+                    node_name,
+                    timestamp_reconnect,
+                    attempts,
+                )
+                self.notify(
+                    Responses.get_message(
+                        "SUCCESS_NODE_RECONNECTED_AFTER_ATTEMPTS",
+                        node_name=node_name,
+                        node_ip=node_ip,
+                        timestamp=timestamp_reconnect,
+                        downtime_minutes=downtime_minutes,
+                        attempts=attempts,
+                    ),
+                    parse_mode="HTML",
+                )
+                write_pipe.srem(self.disconnected_nodes_key, node_id)
+                write_pipe.delete(node_disconnect_time_key)
+            else:
+                # Если все попытки неудачны
+                timestamp_failure = now_str
+                logging.error(
+                    "Не удалось переподключить узел %s в %s.",
+                    node_name,
+                    timestamp_failure,
+                )
+                self.notify(
+                    Responses.get_message(
+                        "ERROR_NODE_RECONNECT_FAILED",
+                        node_name=node_name,
+                        node_ip=node_ip,
+                        error_message=node_message,
+                        attempts=self.reconnect_attempts,
+                        timestamp=timestamp_failure,
+                    ),
+                    parse_mode="HTML",
+                )
+                write_pipe.sadd(self.disconnected_nodes_key, node_id)
+                write_pipe.expire(node_disconnect_time_key, self.node_state_ttl)
+
+    async def reconnect_with_verify(self, node_id, node_name):
+        """Переподключение узла с проверкой статуса.
+
+        Возвращает номер успешной попытки или None, если все попытки неудачны.
+        """
+        for i in range(self.reconnect_attempts):
+            try:
+                await self.api.reconnect_node_async(node_id)
+                await asyncio.sleep(self.node_check_delay)
+                node_status = await self.api.get_node_async(node_id)
+
+                if node_status["status"] == "connected":
+                    return i + 1
+            except Exception as e:
+                logging.error("Ошибка при переподключении узла %s: %s", node_name, e)
+                await asyncio.sleep(self.reconnect_delay)
+        return None
+
+    async def monitor(self):
+        # SIGTERM (docker stop) отменяет задачу, чтобы соединения закрылись штатно
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel
+            )
+        except NotImplementedError:
+            pass
+
+        self.migrate_legacy_state()
+        notify_task = asyncio.create_task(self.notify_worker())
+        self.notify(
             Responses.get_message("MONITOR_START"),
             parse_mode="HTML",
         )
+        async with self.api:
+            try:
+                await self.monitor_loop()
+            except asyncio.CancelledError:
+                logging.info("Мониторинг остановлен.")
+
+        # Перед выходом отправляются накопившиеся уведомления
+        try:
+            await asyncio.wait_for(
+                self.notify_queue.join(), timeout=self.notify_flush_timeout
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Не все уведомления были отправлены до остановки.")
+        notify_task.cancel()
+
+    def migrate_legacy_state(self):
+        """Переносит флаги node_status:<id> в множество отключенных узлов."""
+        try:
+            legacy_keys = list(
+                self.redis.scan_iter(match=f"{self.legacy_node_status_prefix}*")
+            )
+            if not legacy_keys:
+                return
+
+            values = self.redis.mget(legacy_keys)
+            disconnected = [
+                int(key[len(self.legacy_node_status_prefix):])
+                for key, value in zip(legacy_keys, values)
+                if value == b"disconnected"
+            ]
+
+            pipe = self.redis.pipeline(transaction=False)
+            if disconnected:
+                pipe.sadd(self.disconnected_nodes_key, *disconnected)
+            pipe.delete(*legacy_keys)
+            # Время отключения из предыдущих версий записывалось без TTL
+            for key in self.redis.scan_iter(
+                match=f"{self.node_disconnect_time_prefix}*"
+            ):
+                pipe.expire(key, self.node_state_ttl)
+            pipe.execute()
+            logging.info(
+                "Перенесено состояние %s узлов из устаревших ключей.",
+                len(disconnected),
+            )
+        except (redis.RedisError, ValueError) as e:
+            logging.error("Ошибка при переносе состояния узлов: %s", e)
+
+    async def check_nodes(self, nodes, now_str):
+        """Проверка узлов с пакетным чтением и записью состояния в Redis.
+
+        Узлы, отсутствующие в списке, удаляются из множества отключенных.
+        """
+        # Ключи Redis для всех узлов вычисляются один раз за цикл
+        disconnect_time_keys = {
+            n["id"]: f"{self.node_disconnect_time_prefix}{n['id']}" for n in nodes
+        }
+
+        # Все чтения состояния узлов выполняются за один запрос к Redis
+        read_pipe = self.redis.pipeline(transaction=False)
+        read_pipe.smembers(self.disconnected_nodes_key)
+        if nodes:
+            read_pipe.mget(list(disconnect_time_keys.values()))
+        results = read_pipe.execute()
+        disconnected_set = set(int(x) for x in results[0])
+        disconnect_times = results[1] if nodes else []
+
+        # Записи накапливаются и отправляются одним запросом в конце цикла
+        write_pipe = self.redis.pipeline(transaction=False)
+
+        missing = disconnected_set - set(disconnect_time_keys)
+        if missing:
+            write_pipe.srem(self.disconnected_nodes_key, *missing)
+
+        # Время отключения живет, пока узел числится отключенным, даже если он
+        # выключен и не проходит через неудачное переподключение
+        for node_id in disconnected_set & set(disconnect_time_keys):
+            write_pipe.expire(disconnect_time_keys[node_id], self.node_state_ttl)
+
+        # Узлы проверяются параллельно
+        outcomes = await asyncio.gather(
+            *[
+                self.handle_node(
+                    node,
+                    disconnect_time_keys[node["id"]],
+                    node["id"] in disconnected_set,
+                    disconnect_times[index],
+                    write_pipe,
+                    now_str,
+                )
+                for index, node in enumerate(nodes)
+            ],
+            return_exceptions=True,
+        )
+
+        write_pipe.execute()
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome
+
+    async def monitor_loop(self):
         while True:
+            # Время форматируется один раз за цикл и обновляется после ожиданий
+            now_str = _now_str()
             try:
                 logging.info("Начало мониторинга узлов...")
                 start_time = time.time()
 
                 try:
-                    nodes = self.api.get_nodes()
+                    nodes = await self.api.get_nodes_async()
                     elapsed_time = time.time() - start_time
-                    logging.info(f"Запрос узлов выполнен за {elapsed_time:.2f} секунд")
-                    logging.info(f"Получено {len(nodes)} узлов для мониторинга.")
+                    logging.info("Запрос узлов выполнен за %.2f секунд", elapsed_time)
+                    logging.info("Получено %s узлов для мониторинга.", len(nodes))
                 except TimeoutError:
                     logging.error("Timeout while retrieving nodes")
-                    self.notifier.send_message(
+                    self.notify(
                         Responses.get_message(
                             "ERROR_MONITOR_FAILURE",
                             error_message="Timeout while retrieving nodes",
-                            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            timestamp=now_str,
                         ),
                         parse_mode="HTML",
                     )
-                    time.sleep(self.sleep_interval)  # Задержка перед следующей попыткой
+                    # Задержка перед следующей попыткой
+                    await asyncio.sleep(self.sleep_interval)
                     continue
                 except Exception as e:
-                    logging.error(f"Ошибка при получении узлов: {e}")
-                    self.notifier.send_message(
+                    logging.error("Ошибка при получении узлов: %s", e)
+                    self.notify(
                         Responses.get_message(
                             "ERROR_MONITOR_FAILURE",
                             error_message=str(e),
-                            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            timestamp=now_str,
                         ),
                         parse_mode="HTML",
                     )
-                    time.sleep(self.sleep_interval)
+                    await asyncio.sleep(self.sleep_interval)
                     continue
 
-                for node in nodes:
-                    self.log_node_info(node)
-
-                    node_id = node["id"]
-                    node_name = node["name"]
-                    node_ip = node.get("address", "IP не указан")
-                    node_message = node.get("message", "Ошибка не указана")
-                    node_redis_key = self.get_node_status_key(node_id)
-                    node_disconnect_time_key = self.get_node_disconnect_time_key(
-                        node_id
-                    )
-
-                    try:
-                        node_status = self.api.get_node(node_id)
-                    except TimeoutError:
-                        logging.error(
-                            f"Timeout while retrieving status for node {node_name}"
-                        )
-                        continue
-                    except Exception as e:
-                        logging.error(
-                            f"Ошибка при получении статуса узла {node_name}: {e}"
-                        )
-                        continue
-
-                    current_status = node_status.get("status", "unknown")
-                    logging.info(f"Статус узла {node_name}: {current_status}")
-
-                    # Если узел восстановился
-                    if (
-                        self.redis.get(node_redis_key) == b"disconnected"
-                        and current_status == "connected"
-                    ):
-                        disconnect_time = self.redis.get(node_disconnect_time_key)
-                        if disconnect_time:
-                            disconnect_time = float(disconnect_time)
-                            reconnect_time = time.time()
-                            downtime = reconnect_time - disconnect_time
-                            downtime_minutes = round(downtime / 60, 2)
-                            timestamp_reconnect = datetime.now().strftime(
-                                "%Y-%m-%d %H:%M:%S"
-                            )
-                            logging.info(
-                                f"Узел {node_name} восстановлен через "
-                                f"{downtime_minutes} минут."
-                            )
-                            self.notifier.send_message(
-                                Responses.get_message(
-                                    "SUCCESS_NODE_RECONNECTED",
-                                    node_name=node_name,
-                                    node_ip=node_ip,
-                                    timestamp=timestamp_reconnect,
-                                    downtime_minutes=downtime_minutes,
-                                ),
-                                parse_mode="HTML",
-                            )
-                        self.redis.delete(node_redis_key)
-                        self.redis.delete(node_disconnect_time_key)
-
-                    # Если узел отключен
-                    if current_status not in ["connected", "disabled"]:
-                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        logging.warning(
-                            f"Узел {node_name} ({node_ip}) отключен. "
-                            f"Попытка переподключения в {timestamp}..."
-                        )
-
-                        if self.redis.get(node_redis_key) != b"disconnected":
-                            self.notifier.send_message(
-                                Responses.get_message(
-                                    "ERROR_NODE_DISCONNECTED",
-                                    node_name=node_name,
-                                    node_ip=node_ip,
-                                    error_message=node_message,
-                                    timestamp=timestamp,
-                                ),
-                                parse_mode="HTML",
-                            )
-                            self.redis.set(node_disconnect_time_key, time.time())
-
-                        # Попытка переподключения
-                        for i in range(self.reconnect_attempts):
-                            try:
-                                self.api.reconnect_node(node_id)
-                                time.sleep(self.node_check_delay)
-                                node_status = self.api.get_node(node_id)
-
-                                if node_status["status"] == "connected":
-                                    timestamp_reconnect = datetime.now().strftime(
-                                        "%Y-%m-%d %H:%M:%S"
-                                    )
-                                    logging.info(
-                                        f"Узел {node_name} успешно переподключен в "
-                                        f"{timestamp_reconnect} после {i + 1} попыток."
-                                    )
-                                    self.notifier.send_message(
-                                        Responses.get_message(
-                                            "SUCCESS_NODE_RECONNECTED_AFTER_ATTEMPTS",
-                                            node_name=node_name,
-                                            node_ip=node_ip,
-                                            timestamp=timestamp_reconnect,
-                                            attempts=i + 1,
-                                        ),
-                                        parse_mode="HTML",
-                                    )
-                                    self.redis.delete(node_redis_key)
-                                    self.redis.delete(node_disconnect_time_key)
-                                    break
-                            except Exception as e:
-                                logging.error(
-                                    f"Ошибка при переподключении узла {node_name}: {e}"
-                                )
-                                time.sleep(self.reconnect_delay)
-
-                        else:
-                            # Если все попытки неудачны
-                            timestamp_failure = datetime.now().strftime(
-                                "%Y-%m-%d %H:%M:%S"
-                            )
-                            logging.error(
-                                f"Не удалось переподключить узел {node_name} "
-                                f"в {timestamp_failure}."
-                            )
-                            self.notifier.send_message(
-                                Responses.get_message(
-                                    "ERROR_NODE_RECONNECT_FAILED",
-                                    node_name=node_name,
-                                    node_ip=node_ip,
-                                    error_message=node_message,
-                                    attempts=self.reconnect_attempts,
-                                    timestamp=timestamp_failure,
-                                ),
-                                parse_mode="HTML",
-                            )
-                            self.redis.set(node_redis_key, "disconnected")
-
-                time.sleep(self.sleep_interval)
+                await self.check_nodes(nodes, now_str)
+                await asyncio.sleep(self.sleep_interval)
 
             except Exception as e:
-                timestamp_error = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                logging.error(f"Ошибка при мониторинге узлов: {e} в {timestamp_error}")
-                self.notifier.send_message(
+                timestamp_error = _now_str()
+                logging.error(
+                    "Ошибка при мониторинге узлов: %s в %s", e, timestamp_error
+                )
+                self.notify(
                     Responses.get_message(
                         "ERROR_MONITOR_FAILURE",
                         error_message=str(e),